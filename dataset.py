@@ -1,11 +1,27 @@
 import torch
 import torchvision
 import torchvision.transforms as transforms
+from torchvision.transforms import v2
 import numpy as np
 import os
 
 from torch.utils.data import Dataset
 
+# (min, max) over the entire Mirflickr dataset, used to rescale inputs and targets to [0, 1].
+# The ranges' reciprocals are precomputed so the rescale is a multiply, not a per-element divide.
+IN_MIN, IN_MAX = -0.0079, 0.9004
+TARGET_MIN, TARGET_MAX = 4.1243e-05, 1.0
+IN_SCALE = 1.0 / (IN_MAX - IN_MIN)
+TARGET_SCALE = 1.0 / (TARGET_MAX - TARGET_MIN)
+
+# Min-max rescale a batched input/target pair to [0, 1]. Runs as fused in-place elementwise ops on
+# whatever device the tensors live on (the GPU after the H2D copy in train.py), instead of per-sample
+# NumPy passes inside every dataloader worker.
+def normalize_mirflickr(image, target):
+    image = image.sub_(IN_MIN).mul_(IN_SCALE)
+    target = target.sub_(TARGET_MIN).mul_(TARGET_SCALE)
+    return image, target
+
 class Mirflickr(Dataset):
     def __init__(self, root_dir, data_list=None, target_list=None, input_transform=None, target_transform=None):
         super().__init__()
@@ -13,30 +29,49 @@ class Mirflickr(Dataset):
         self.data_dir = os.path.join(root_dir, "diffuser_images_npy")
         self.target_dir = os.path.join(root_dir, "ground_truth_lensed_npy")
 
-        if data_list == None: 
-            self.data_list = os.listdir(self.data_dir)
+        if data_list == None:
+            self.data_list = sorted(os.listdir(self.data_dir))          # sorted so index i pairs the same image across both folders (listdir order is filesystem-dependent)
         else:
             self.data_list = data_list
-        
+
         if target_list == None:
-            self.target_list = os.listdir(self.target_dir)
+            self.target_list = sorted(os.listdir(self.target_dir))
         else:
             self.target_list = target_list
 
         self.in_transform = input_transform
         self.target_transform = target_transform
 
+        # If the one-time tensorize_mirflickr.py preprocessing has been run, read samples out of one
+        # memory-mapped stack per folder (an O(1) slice, no open() syscalls or header parsing) instead
+        # of np.load-ing two files per sample. Rows in the stacks follow sorted directory order.
+        data_stack = os.path.join(root_dir, "diffuser_images.npy")
+        target_stack = os.path.join(root_dir, "ground_truth_lensed.npy")
+        if os.path.exists(data_stack) and os.path.exists(target_stack):
+            self.inputs = np.load(data_stack, mmap_mode='r')
+            self.targets = np.load(target_stack, mmap_mode='r')
+            # stack rows follow sorted directory order; reuse our own listing instead of re-scanning when we hold the full one
+            data_row = {name: row for row, name in enumerate(self.data_list if data_list == None else sorted(os.listdir(self.data_dir)))}
+            target_row = {name: row for row, name in enumerate(self.target_list if target_list == None else sorted(os.listdir(self.target_dir)))}
+            self.data_rows = [data_row[name] for name in self.data_list]
+            self.target_rows = [target_row[name] for name in self.target_list]
+        else:
+            self.inputs = None
+            self.targets = None
+
     def __len__(self):
         return len(self.data_list)
 
     def __getitem__(self, index):
-        image = np.load(os.path.join(self.data_dir, self.data_list[index]))
-        target = np.load(os.path.join(self.target_dir, self.target_list[index]))
+        if self.inputs is not None:
+            image = np.asarray(self.inputs[self.data_rows[index]], dtype=np.float32)
+            target = np.asarray(self.targets[self.target_rows[index]], dtype=np.float32)
+        else:
+            image = np.load(os.path.join(self.data_dir, self.data_list[index]))
+            target = np.load(os.path.join(self.target_dir, self.target_list[index]))
         img_name = self.data_list[index][:-4]      # get image name without the .npy extension
 
-        # Normalize both input images and ground truth images to range (0, 1) using the max and min of the entire dataset
-        image = (image - (-0.0079)) / (0.9004 - (-0.0079))         # (max, min) of inputs is (0.9004, -0.0079)
-        target = (target - 4.1243e-05 / (1 - 4.1243e-05))          # (max, min) of targets is (1, 4.1243e-05)
+        # Normalization to (0, 1) happens batched on the GPU via normalize_mirflickr (called in train.py)
 
         # totensor changes channel order from (H, W, C) to (C, H, W)
         if self.in_transform:
@@ -47,13 +82,25 @@ class Mirflickr(Dataset):
         return image, target, img_name
     
 
+# Batched augmentation that runs on the GPU after the H2D copy (the train dataset returns raw uint8
+# tensors). RandAugment is far too slow to run per-sample in the CPU workers; batched on device it
+# costs a few kernels per batch. kornia rather than torchvision v2 here: v2 transforms draw one set
+# of random parameters per call, so a batched call would give every image in the batch the identical
+# crop/flip/RandAugment ops, while same_on_batch=False samples fresh parameters per image. Returns
+# None when the dataset needs no GPU-side augmentation.
+def get_gpu_augmentation(dataset, min_side_len):
+    if dataset == "CIFAR10":
+        import kornia.augmentation as K         # imported lazily - only the CIFAR10 GPU-augmentation path needs kornia
+        return K.AugmentationSequential(K.RandomCrop((min_side_len, min_side_len), padding=4),
+                                        K.RandomHorizontalFlip(),
+                                        K.auto.RandAugment(n=2, m=10),  # RandAugment augmentation for strong regularization
+                                        K.Normalize(mean=torch.tensor([0.4914, 0.4822, 0.4465]), std=torch.tensor([0.2470, 0.2435, 0.2616])),        # positional embedding cannot take negative values (center around mean not around 0)
+                                        same_on_batch=False)
+    return None
+
 def get_loader(dataset, min_side_len, batch_size, num_workers, root_dir="/home/ponoma/workspace/DATA/mirflickr_dataset/"):
     if dataset=="CIFAR10":
-        train_transform = torchvision.transforms.Compose([transforms.RandomCrop(min_side_len, padding=4), 
-                                            transforms.RandomHorizontalFlip(),
-                                            transforms.RandAugment(),  # RandAugment augmentation for strong regularization
-                                            transforms.ToTensor(), 
-                                            transforms.Normalize([0.4914, 0.4822, 0.4465], [0.2470, 0.2435, 0.2616])])          # positional embedding cannot take negative values (center around mean not around 0)                    
+        train_transform = v2.PILToTensor()          # uint8 CHW only - augmentation + normalization happen batched on the GPU (get_gpu_augmentation)
 
         val_transform = torchvision.transforms.Compose([transforms.ToTensor(),
                                                         transforms.Normalize([0.4914, 0.4822, 0.4465], [0.2470, 0.2435, 0.2616]),])
@@ -62,27 +109,28 @@ def get_loader(dataset, min_side_len, batch_size, num_workers, root_dir="/home/p
         testset = None
 
     elif dataset=="Mirflickr":
-        train_transform = torchvision.transforms.Compose([transforms.ToTensor(), 
-                                                          transforms.CenterCrop((min_side_len, min_side_len))])                       
-
-        val_transform = torchvision.transforms.Compose([transforms.ToTensor(), 
-                                                          transforms.CenterCrop((min_side_len, min_side_len))])  
+        transform = torchvision.transforms.Compose([transforms.ToTensor(),
+                                                    transforms.CenterCrop((min_side_len, min_side_len))])
 
-        dataset = Mirflickr(root_dir)           # Make it take in a list of 
+        # One dataset (one listdir per directory) split by index into Subsets, instead of building a
+        # throwaway Mirflickr plus three more that each re-scan the directories. The old code also
+        # handed every split the *full* file lists, so train/val/test all saw the whole dataset.
+        full_dataset = Mirflickr(root_dir, input_transform=transform, target_transform=transform)
         generator = torch.Generator().manual_seed(3)        # generator should yield deterministic behavior
-        trainset, valset, testset = torch.utils.data.random_split(dataset, [0.7, 0.15, 0.15], generator)
+        trainset, valset, testset = torch.utils.data.random_split(full_dataset, [0.7, 0.15, 0.15], generator)
 
-        # Apply transforms after doing random split
-        trainset = Mirflickr(root_dir, trainset.dataset.data_list, trainset.dataset.target_list, input_transform=train_transform, target_transform=train_transform)
-        valset = Mirflickr(root_dir, valset.dataset.data_list, valset.dataset.target_list, val_transform, val_transform)
-        testset = Mirflickr(root_dir, testset.dataset.data_list, testset.dataset.target_list, val_transform, val_transform)
-        
     else:
         raise("Unkown dataset.")
     
-    train_loader = torch.utils.data.DataLoader(trainset, batch_size=batch_size, shuffle=True, num_workers=num_workers)
-    val_loader = torch.utils.data.DataLoader(valset, batch_size=batch_size, shuffle=False, num_workers=num_workers)
-    test_loader = torch.utils.data.DataLoader(testset, batch_size=batch_size, shuffle=False, num_workers=num_workers)
+    # pin_memory enables async (non_blocking) H2D copies; persistent_workers avoids re-forking the
+    # worker pool every epoch; prefetch_factor keeps a few batches in flight per worker.
+    # drop_last keeps train batch shapes fixed, which cudnn.benchmark and torch.compile like.
+    loader_args = {"num_workers": num_workers, "pin_memory": True}
+    if num_workers > 0:
+        loader_args.update({"persistent_workers": True, "prefetch_factor": 4})
+    train_loader = torch.utils.data.DataLoader(trainset, batch_size=batch_size, shuffle=True, drop_last=True, **loader_args)
+    val_loader = torch.utils.data.DataLoader(valset, batch_size=batch_size, shuffle=False, **loader_args)
+    test_loader = torch.utils.data.DataLoader(testset, batch_size=batch_size, shuffle=False, **loader_args)
 
     return train_loader, val_loader, test_loader
     
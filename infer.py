@@ -4,7 +4,7 @@ from tqdm import tqdm
 import torchvision.transforms as transforms
 
 from recon_model import Recon_Transformer
-from dataset import get_loader
+from dataset import get_loader, normalize_mirflickr
 from PIL import Image
 
 os.environ["CUDA_DEVICE_ORDER"] = "PCI_BUS_ID" 
@@ -46,7 +46,8 @@ def main():
         model.eval()
         for step, batch in enumerate(tqdm(test_loader)):
             input, target, img_name = batch
-            input, target = input.to(device), target.to(device)
+            input, target = input.to(device, non_blocking=True), target.to(device, non_blocking=True)
+            input, target = normalize_mirflickr(input, target)      # normalization moved out of the dataset onto the device
             output = model(input)
             output = transforms.ToPILImage()(output.squeeze())
             output.save(os.path.join(infer_results, img_name[0] + '.jpg'), format='JPEG')       # Test if this works
@@ -15,8 +15,8 @@ class Transformer(nn.Module):
         self.flatten = nn.Flatten()                              # flatten the input sequence since we are dealing with images
         self.in_embedding = nn.Embedding(in_dim, d_model)               # input embedding layer
         self.out_embedding = nn.Embedding(out_dim, d_model)             # output embedding layer
-        self.in_positional_encoding = Positional_Encoding(d_model, device)      # input positional encoding for encoder
-        self.out_positional_encoding = Positional_Encoding(d_model, device)     # output positional encoding for decoder
+        self.in_positional_encoding = Positional_Encoding(d_model)      # input positional encoding for encoder
+        self.out_positional_encoding = Positional_Encoding(d_model)     # output positional encoding for decoder
 
         self.linear = nn.Linear(d_model, out_dim)                       # linear layer to get output classes
         self.softmax = nn.Softmax(dim=-1)                               # softmax to get probabilities of each class
@@ -73,26 +73,24 @@ class Encoder_Block(nn.Module):
         self.Wq = nn.Linear(d_model, d_model)                    # paper says it uses dim = 512 for outputs for all embeddings
         self.Wk = nn.Linear(d_model, d_model)                    # if implementing multiheaded attention later, good to have these here to use in both mutltiheaded and self-attention classes
         self.Wv = nn.Linear(d_model, d_model)
-        self.attention = Multi_Headed_Attention(n_heads, d_model, device)    
-        self.dropout1 = nn.Dropout(dropout_rate)
-        self.add_and_norm1 = Add_and_Norm(d_model)     
+        self.attention = Multi_Headed_Attention(n_heads, d_model, dropout_rate)         # dropout happens inside the fused attention kernel
+        self.norm1 = nn.LayerNorm(d_model)
 
         self.ffn = Position_wise_ffn(d_model, d_ffn)            # output has dimension d_model
         self.dropout2 = nn.Dropout(dropout_rate)
-        self.add_and_norm2 = Add_and_Norm(d_model)
+        self.norm2 = nn.LayerNorm(d_model)
 
+    # pre-norm: normalize the sublayer input and add the residual after, as in the ViT encoder blocks.
+    # More stable to train than the original post-norm and the residual add fuses into the next norm's read.
     def forward(self, x):
-        Q = self.Wq(x)                                  # dimensions = (batch_size, seq_len, d_model) for Q, K, V
-        K = self.Wk(x)
-        V = self.Wv(x)
-        attention_layer = self.attention(Q, K, V)
-        attention_layer = self.dropout1(attention_layer) 
-        x = self.add_and_norm1(attention_layer, x)            # x is original input embedding
-
-        ffn = self.ffn(x)
-        ffn = self.dropout2(ffn)
-        ffn = self.add_and_norm2(x, ffn)
-        return ffn
+        h = self.norm1(x)
+        Q = self.Wq(h)                                  # dimensions = (batch_size, seq_len, d_model) for Q, K, V
+        K = self.Wk(h)
+        V = self.Wv(h)
+        x = x + self.attention(Q, K, V)
+
+        x = x + self.dropout2(self.ffn(self.norm2(x)))
+        return x
 
 class Decoder_Block(nn.Module):
     def __init__(self, d_model, d_ffn, n_heads, dropout_rate, device):
@@ -105,66 +103,63 @@ class Decoder_Block(nn.Module):
         self.Wq_1 = nn.Linear(d_model, d_model)                    # paper says it uses dim = 512 for outputs for all embeddings
         self.Wk_1 = nn.Linear(d_model, d_model)                    # if implementing multiheaded attention later, good to have these here to use in both mutltiheaded and self-attention classes
         self.Wv_1 = nn.Linear(d_model, d_model)
-        self.attention1 = Multi_Headed_Attention(n_heads, d_model, device)    
-        self.dropout1 = nn.Dropout(dropout_rate)
-        self.add_and_norm1 = Add_and_Norm(d_model)
+        self.attention1 = Multi_Headed_Attention(n_heads, d_model, dropout_rate)        # dropout happens inside the fused attention kernel
+        self.norm1 = nn.LayerNorm(d_model)
 
         # encoder-decoder attention (using keys and values from encoder)
         self.Wq_2 = nn.Linear(d_model, d_model)
         self.Wk_2 = nn.Linear(d_model, d_model)
         self.Wv_2 = nn.Linear(d_model, d_model)
-        self.attention2 = Multi_Headed_Attention(n_heads, d_model, device)
-        self.dropout2 = nn.Dropout(dropout_rate)
-        self.add_and_norm2 = Add_and_Norm(d_model)                   
+        self.attention2 = Multi_Headed_Attention(n_heads, d_model, dropout_rate)
+        self.norm2 = nn.LayerNorm(d_model)
 
         # feed forward network
-        self.ffn = Position_wise_ffn(d_model, d_ffn)            
+        self.ffn = Position_wise_ffn(d_model, d_ffn)
         self.dropout3 = nn.Dropout(dropout_rate)
-        self.add_and_norm3 = Add_and_Norm(d_model)
+        self.norm3 = nn.LayerNorm(d_model)
 
+    # pre-norm, same as Encoder_Block
     def forward(self, encoder_output, x):                   # x = decoder input, which is composed of the target sequence embeddings
-        # masked self-attention 
-        Q_1 = self.Wq_1(x)
-        K_1 = self.Wk_1(x)
-        V_1 = self.Wv_1(x)
-        attention_layer1 = self.attention1(Q_1, K_1, V_1, is_masked=True)          
-        attention_layer1 = self.dropout1(attention_layer1)
-        x = self.add_and_norm1(attention_layer1, x)
+        # masked self-attention
+        h = self.norm1(x)
+        Q_1 = self.Wq_1(h)
+        K_1 = self.Wk_1(h)
+        V_1 = self.Wv_1(h)
+        x = x + self.attention1(Q_1, K_1, V_1, is_masked=True)
 
         # encoder-decoder attention
-        Q_2 = self.Wq_2(x)
+        Q_2 = self.Wq_2(self.norm2(x))
         K_2 = self.Wk_2(encoder_output)
         V_2 = self.Wv_2(encoder_output)
-        attention_layer2 = self.attention2(Q_2, K_2, V_2)
-        attention_layer2 = self.dropout2(attention_layer2)
-        x = self.add_and_norm2(attention_layer2, x)
+        x = x + self.attention2(Q_2, K_2, V_2)
 
         # feed forward network
-        ffn = self.ffn(x)
-        ffn = self.dropout3(ffn)
-        ffn = self.add_and_norm3(x, ffn)
-        return ffn
+        x = x + self.dropout3(self.ffn(self.norm3(x)))
+        return x
 
 
 # Helper classes
 
 # taken from https://pytorch.org/tutorials/beginner/transformer_tutorial.html#:~:text=class%20PositionalEncoding(nn.Module)%3A 
-class Positional_Encoding(nn.Module):                    
-    def __init__(self, d_model, device, dropout_rate=0.1, max_len=5000):
+class Positional_Encoding(nn.Module):
+    def __init__(self, d_model, dropout_rate=0.1, max_len=5000):
         super().__init__()
         self.d_model = d_model
         self.dropout = nn.Dropout(dropout_rate)
-        self.pos_encoding = torch.zeros([1, max_len, d_model], device=device)                       # each "word" has encoding of size d_model
 
-        # calculate e^(2i * log(n)/d_model) where n = 10000 from original paper and i goes from 0 to d_model/2 because there are d_model PAIRS
-        div_term = torch.exp(torch.arange(0, d_model, 2) * -(math.log(torch.tensor(10000.0)) / d_model))  
+        # calculate e^(2i * -log(n)/d_model) where n = 10000 from original paper and i goes from 0 to d_model/2 because there are d_model PAIRS
+        div_term = torch.exp(torch.arange(0, d_model, 2, dtype=torch.float32) * (-math.log(10000.0) / d_model))
 
         # create (max_len, 1) column tensor for all positions (numbered)
         pos = torch.arange(0, max_len).unsqueeze(1)
 
         # broadcast and set even indices to sin  and odd indices to cos
-        self.pos_encoding[0, :, 0::2] = torch.sin(pos * div_term)                  # select all rows. Start at column 0 and skip every 2 cols
-        self.pos_encoding[0, :, 1::2] = torch.cos(pos * div_term)                  
+        pos_encoding = torch.zeros([1, max_len, d_model])                          # each "word" has encoding of size d_model
+        pos_encoding[0, :, 0::2] = torch.sin(pos * div_term)                       # select all rows. Start at column 0 and skip every 2 cols
+        pos_encoding[0, :, 1::2] = torch.cos(pos * div_term)
+
+        # registered as a buffer (not trained): moves with model.to(device) and lives in the state dict
+        self.register_buffer('pos_encoding', pos_encoding)
 
     def forward(self, x):
         x = x + self.pos_encoding[:, :x.size(1)]                                   # trim down pos_encoding to size of actual input sequence. dim = (1, seq_len, d_model)
@@ -184,7 +179,7 @@ class Position_wise_ffn(nn.Module):                           # 2 fully connecte
         return x
 
 class Multi_Headed_Attention(nn.Module):
-    def __init__(self, n_heads, d_model, device):
+    def __init__(self, n_heads, d_model, dropout_rate=0.0):
         super().__init__()
         self.n_heads = n_heads
 
@@ -192,7 +187,7 @@ class Multi_Headed_Attention(nn.Module):
         assert d_model % n_heads == 0
         self.d_key = d_model // n_heads
 
-        self.attention = Self_Attention(device)
+        self.attention = Self_Attention(dropout_rate)
 
     def forward(self, q, k, v, is_masked=False):
         # 1 - split into heads
@@ -215,33 +210,14 @@ class Multi_Headed_Attention(nn.Module):
 
 
 class Self_Attention(nn.Module):            # q and k have dimensions d_v by d_k
-    def __init__(self, device):
-        super().__init__()  
-        self.device = device      
-
-    def forward(self, q, k, v, is_masked, padding=0):
-        d_k = q.size(-1)                                                                                   # get last dimension of q (should be d_k)
-        padding = padding                                                                            
-        attention_weights = torch.matmul(q, k.transpose(-2, -1)) / math.sqrt(d_k)                          # want last two dimensions to get swapped
-        
-        # source/padding mask. Safer to make this into a boolean mask rather than rounding so that numbers won't accidentally be rounded to 0
-        mask = attention_weights != padding                                                                # make sure padding values are not considered in softmax
-
-        # target mask (for decoder)
-        if is_masked:                       
-            # combine padding and target mask. Should have dimensions (target_sequence_len, target_sequence_len)
-            mask = torch.tril(torch.ones([1, attention_weights.size(-1), attention_weights.size(-1)], device=self.device)).bool() & mask    # target sequence length for dim = -1 should be the same as dim = -2   
-        
-        attention_weights = attention_weights.masked_fill(mask == 0, -1e9)                                  # set all values we want to ignore to -infinity
-        
-        probabilities = torch.softmax(attention_weights, dim=-1)                                            # gets the probabilities along last dimension. For 2d the result of softmax is a (d_v, 1) vector.
-        return torch.matmul(probabilities, v)      
-    
-
-class Add_and_Norm(nn.Module):
-    def __init__(self, d_model):
+    def __init__(self, dropout_rate=0.0):
         super().__init__()
-        self.norm = nn.LayerNorm(d_model)
-
-    def forward(self, input, output):
-        return self.norm(input + output)
\ No newline at end of file
+        self.dropout_rate = dropout_rate
+
+    def forward(self, q, k, v, is_masked):
+        # Fused scale/mask/softmax/matmul kernel (FlashAttention on supported GPUs) instead of materializing
+        # the full (batch size, n_heads, seq_len, seq_len) attention-weights tensor. The causal mask for the
+        # decoder is built inside the kernel via is_causal, and softmax dropout is fused in as well.
+        return nn.functional.scaled_dot_product_attention(q, k, v, attn_mask=None,
+                                                          dropout_p=self.dropout_rate if self.training else 0.0,
+                                                          is_causal=is_masked)
\ No newline at end of file
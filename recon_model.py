@@ -1,6 +1,5 @@
 import torch
 from torch import nn
-import math
 
 # based on https://github.com/brandokoch/attention-is-all-you-need-paper/tree/master and pytorch tutorial
 
@@ -50,16 +49,15 @@ class Encoder_Block(nn.Module):
     def __init__(self, embed_dim, ffn_multiplier, n_heads, dropout_rate):
         super().__init__()
 
-        self.attention = Multi_Headed_Attention(n_heads, embed_dim)    
-        self.dropout1 = nn.Dropout(dropout_rate)
-        self.norm1 = nn.LayerNorm(embed_dim)     
+        self.attention = Multi_Headed_Attention(n_heads, embed_dim, dropout_rate)       # dropout happens inside the fused attention kernel
+        self.norm1 = nn.LayerNorm(embed_dim)
 
         self.ffn = Position_wise_ffn(embed_dim, ffn_multiplier)        # transformer paper has multiplier = 4, simplified model has 2
         self.dropout2 = nn.Dropout(dropout_rate)
         self.norm2 = nn.LayerNorm(embed_dim)
 
     def forward(self, x):
-        x = x + self.dropout1(self.attention(self.norm1(x)))        # now most people do residual after dropout + attention
+        x = x + self.attention(self.norm1(x))        # attention applies its own (fused) dropout
         x = x + self.dropout2(self.ffn(self.norm2(x)))
         return x
     
@@ -98,39 +96,34 @@ class Decoder(nn.Module):
 ### Helper classes ###
 
 class Multi_Headed_Attention(nn.Module):
-    def __init__(self, n_heads, embed_dim):
+    def __init__(self, n_heads, embed_dim, dropout_rate=0.0):
         super().__init__()
         self.n_heads = n_heads
+        self.dropout_rate = dropout_rate
 
         # If doesn't divide evenly, concatenation won't work.
         assert embed_dim % n_heads == 0
         self.d_key = embed_dim // n_heads
 
-        self.Wq = nn.Linear(embed_dim, embed_dim)     
-        self.Wk = nn.Linear(embed_dim, embed_dim)     
-        self.Wv = nn.Linear(embed_dim, embed_dim)
+        # Q, K and V are computed from the same input x, so the three projections can be one GEMM
+        # of shape (embed_dim, 3*embed_dim) instead of three kernel launches over the same activation.
+        self.Wqkv = nn.Linear(embed_dim, 3 * embed_dim)
 
         self.projection = nn.Linear(embed_dim, embed_dim)
 
     def forward(self, x):
-        q = self.Wq(x)      # dimensions = (batch_size, seq_len, embed_dim) for Q, K, V
-        k = self.Wk(x)
-        v = self.Wv(x)
+        # 1 - single fused projection, then split into q/k/v and heads in one reshape
+        qkv = self.Wqkv(x).view(x.size(0), x.size(1), 3, self.n_heads, self.d_key)
 
-        # 1 - split into heads
-        q = q.view(q.size(0), q.size(1), self.n_heads, self.d_key)     # (batch size, sequence len, num heads, d_key)
-        k = k.view(k.size(0), k.size(1), self.n_heads, self.d_key)
-        v = v.view(v.size(0), v.size(1), self.n_heads, self.d_key)
+        # 2 - move the qkv dimension out front and swap n_heads with sequence length
+        qkv = qkv.permute(2, 0, 3, 1, 4)            # (3, batch size, n_heads, sequence len, d_key)
+        q, k, v = qkv.unbind(0)
 
-        # 2 - swap n_heads and sequence length dimensions to split each batch along each head
-        q = q.transpose(1, 2)             # (batch size, n_heads, sequence len, d_key)
-        k = k.transpose(1, 2)
-        v = v.transpose(1, 2)
-
-        # 3 - Do self-attention                                                                           
-        attention_weights = torch.matmul(q, k.transpose(-2, -1)) / math.sqrt(q.size(-1))       # want last two dimensions to get swapped
-        probabilities = torch.softmax(attention_weights, dim=-1)         # gets the probabilities along last dimension. For 2d the result of softmax is a (d_v, 1) vector.
-        output = torch.matmul(probabilities, v) 
+        # 3 - Do self-attention with the fused scale/softmax/matmul kernel (FlashAttention on supported GPUs)
+        # instead of materializing the full (batch size, n_heads, seq_len, seq_len) weights tensor. Softmax
+        # dropout is fused into the same kernel.
+        output = nn.functional.scaled_dot_product_attention(q, k, v, attn_mask=None,
+                                                            dropout_p=self.dropout_rate if self.training else 0.0)
 
         # 4 - Reverse step 2 then concatenate heads
         output = output.transpose(1, 2).contiguous()            # Need contiguous because .view() changes the way the tensor is stored (not stored consecutively in memory anymore)
@@ -148,14 +141,18 @@ class Patch_Embedding(nn.Module):
         self.num_patches = (img_side_len // patch_size) ** 2        # TODO: assumes the image is square
         
         # Note: positional embedding in ViT does not use sine/cosine
-        self.conv = torch.nn.Conv2d(n_channels, embed_dim, kernel_size=patch_size, stride=patch_size)         # no overlapping means stride needs to be same as patch size
+        # With stride == kernel size the patchify conv is exactly a per-patch linear projection,
+        # so slice the image into patches with unfold and run one GEMM instead of conv + flatten + transpose.
+        self.proj = nn.Linear(n_channels * patch_size * patch_size, embed_dim)
         self.embedding = nn.Parameter(torch.zeros([1, self.num_patches, self.embed_dim], requires_grad=True))
         self.dropout = nn.Dropout(dropout_rate)
 
     def forward(self, x):
-        x = self.conv(x)        # (batch size, channels, height, width) => (batch size, embed_dim, height/patch size, width/patch size)
-        x = torch.flatten(x, 2)         # result = (batch size, embed_dim, num_patches). 
-        x = x.transpose(1, 2)           # switch to having num_patch tensors of dim embed_dim (for efficient memory storage since embedding dimension is usually smaller than sequence length/number of patches)
+        P = self.patch_size
+        x = x.unfold(2, P, P).unfold(3, P, P)           # (batch size, channels, height/patch size, width/patch size, patch size, patch size)
+        x = x.permute(0, 2, 3, 1, 4, 5)                 # group the per-patch pixels together: (batch size, h patches, w patches, channels, patch size, patch size)
+        x = x.reshape(x.size(0), -1, self.proj.in_features)     # one row of length channels * patch_size^2 per patch
+        x = self.proj(x)        # (batch size, num_patches, embed_dim) in a single GEMM
 
         x = x + self.embedding
         x = self.dropout(x)
@@ -167,7 +164,7 @@ class Position_wise_ffn(nn.Module):                           # 2 fully connecte
         super().__init__()
         self.linear1 = nn.Linear(embed_dim, embed_dim * ffn_multiplier)
         self.linear2 = nn.Linear(embed_dim * ffn_multiplier, embed_dim)
-        self.gelu = nn.GELU()
+        self.gelu = nn.GELU(approximate='tanh')         # BERT/ViT-style tanh approximation: ~2x cheaper per element than the exact erf form and fuses with the preceding bias under torch.compile
     
     def forward(self, x):
         x = self.linear1(x)         
@@ -0,0 +1,27 @@
+import numpy as np
+import os
+from tqdm import tqdm
+
+# One-time preprocessing for the Mirflickr lensless data: stack the thousands of per-image .npy files
+# into a single memory-mapped .npy per folder so Mirflickr.__getitem__ becomes an O(1) slice of an
+# already-open array instead of two np.load() calls (each one an open() syscall + header parse).
+# Run once after downloading the dataset; dataset.py picks the stacked files up automatically.
+
+root_dir = "/home/ponoma/workspace/DATA/mirflickr_dataset/"
+
+def tensorize(src_dir, out_path):
+    names = sorted(os.listdir(src_dir))         # sorted so the row order is reproducible
+    first = np.load(os.path.join(src_dir, names[0]))
+
+    # float16 halves the file size and per-sample read; values are in a ~[0, 1] range so the precision loss is negligible
+    stacked = np.lib.format.open_memmap(out_path, mode='w+', dtype=np.float16, shape=(len(names),) + first.shape)
+    for i, name in enumerate(tqdm(names)):
+        stacked[i] = np.load(os.path.join(src_dir, name)).astype(np.float16)
+    stacked.flush()
+
+def main():
+    tensorize(os.path.join(root_dir, "diffuser_images_npy"), os.path.join(root_dir, "diffuser_images.npy"))
+    tensorize(os.path.join(root_dir, "ground_truth_lensed_npy"), os.path.join(root_dir, "ground_truth_lensed.npy"))
+
+if __name__ == "__main__":
+    main()
@@ -5,13 +5,21 @@ import wandb
 
 from classification_model import Transformer
 from recon_model import Recon_Transformer
-from dataset import get_loader
+from dataset import get_loader, get_gpu_augmentation, normalize_mirflickr
+from utils import CUDAPrefetcher, CUDAGraphedStep
 
 os.environ["CUDA_DEVICE_ORDER"] = "PCI_BUS_ID" 
 os.environ["CUDA_VISIBLE_DEVICES"] = '0,1,2'
 gpu_number = 0
 
 def main():
+    # Input shapes are fixed (drop_last on the train loader), so let cuDNN benchmark conv algorithms
+    # once and reuse the winner, and allow TF32 on Ampere+ tensor cores for the fp32 matmuls/convs.
+    torch.backends.cudnn.benchmark = True
+    torch.backends.cuda.matmul.allow_tf32 = True
+    torch.backends.cudnn.allow_tf32 = True
+    torch.set_float32_matmul_precision('high')
+
     debug = False
 
     dataset = "Mirflickr"           # 'Mirflickr' or 'CIFAR10'
@@ -28,7 +36,8 @@ def main():
     ffn_multiplier = 2
     min_side_len = 270
     dropout_rate = 0.1
-    num_workers = 4
+    num_workers = os.cpu_count() // 2
+    use_cuda_graphs = False     # capture the whole train step as one CUDA graph launch. Alternative to torch.compile, whose reduce-overhead mode already applies graphs
     save_path = './checkpoint/' #'./checkpoint_experiment/'
     class_names = ['plane', 'car', 'bird', 'cat', 'deer', 'dog', 'frog', 'horse', 'ship', 'truck']      # For confusion matrix
     if not debug:
@@ -49,6 +58,7 @@ def main():
 
     # Get data loaders
     train_loader, val_loader, _ = get_loader(dataset, min_side_len, batch_size, num_workers)
+    train_augment = get_gpu_augmentation(dataset, min_side_len)         # batched augmentation applied on the GPU in train_epoch (None for Mirflickr)
 
     # See if gpu is available
     if torch.cuda.is_available():
@@ -63,28 +73,44 @@ def main():
     elif dataset == "Mirflickr":
         model = Recon_Transformer(min_side_len, patch_size, n_channels, num_heads, num_blocks, embed_dim, ffn_multiplier, dropout_rate)
     model.to(device)
+    model = model.to(memory_format=torch.channels_last)         # NHWC weights for the ConvTranspose2d/BatchNorm2d stack in the recon decoder; a no-op for the conv-free ViT encoder
 
-    optimizer = torch.optim.AdamW(model.parameters(), lr=learning_rate, weight_decay=1e-3)         
+    optimizer = torch.optim.AdamW(model.parameters(), lr=learning_rate, weight_decay=1e-3)
     criterion = torch.nn.CrossEntropyLoss()
 
+    # Mixed-precision training. bf16 keeps fp32's exponent range so it needs no loss scaling on Ampere+;
+    # switch amp_dtype to torch.float16 on older GPUs, which enables the GradScaler below.
+    amp_dtype = torch.bfloat16
+    scaler = torch.cuda.amp.GradScaler(enabled=(device.type == "cuda" and amp_dtype == torch.float16))
+
+    if use_cuda_graphs and device.type == "cuda" and not scaler.is_enabled():
+        # Replay the fixed-shape forward+loss+backward as a single CUDA graph launch (fp16's GradScaler
+        # can't be captured, hence the is_enabled() guard). Skips torch.compile - the two overlap.
+        graphed_step = CUDAGraphedStep(model, criterion, amp_dtype)
+    else:
+        # Compile the model so Inductor fuses the memory-bound elementwise ops in each encoder block
+        # (residual add + LayerNorm, bias + GELU) into a handful of kernels instead of ~8 launches per block.
+        model = torch.compile(model, mode="reduce-overhead", fullgraph=False)
+        graphed_step = None
+
     if not os.path.exists(save_path):          
         os.mkdir(save_path)
 
-    train(model, train_loader, val_loader, optimizer, criterion, num_epochs, device, save_path, class_names, debug, warmup_epochs)
+    train(model, train_loader, val_loader, optimizer, criterion, scaler, amp_dtype, num_epochs, device, save_path, class_names, debug, warmup_epochs, dataset, graphed_step, train_augment)
     if not debug:
         run.finish()
 
 
 # Includes both training and validation
-def train(model, train_loader, val_loader, optimizer, criterion, num_epochs, device, save_path, class_names, debug, warmup_epochs):
+def train(model, train_loader, val_loader, optimizer, criterion, scaler, amp_dtype, num_epochs, device, save_path, class_names, debug, warmup_epochs, dataset, graphed_step=None, train_augment=None):
     linear_warmup = torch.optim.lr_scheduler.LinearLR(optimizer, start_factor=1/warmup_epochs, end_factor=1.0, total_iters=warmup_epochs-1, last_epoch=-1)
     scheduler = torch.optim.lr_scheduler.CosineAnnealingLR(optimizer=optimizer, T_max=num_epochs-warmup_epochs, eta_min=1e-5)
 
     best_loss = float('inf')
     for epoch in range(num_epochs):
         print(f'Start training epoch {epoch+1}/{num_epochs}...')
-        train_accuracy, train_loss = train_epoch(model, epoch, num_epochs, train_loader, optimizer, criterion, device) 
-        val_acc, val_loss = validate(model, val_loader, criterion, device, save_path, class_names, debug)
+        train_accuracy, train_loss = train_epoch(model, epoch, num_epochs, train_loader, optimizer, criterion, scaler, amp_dtype, device, dataset, graphed_step, train_augment)
+        val_acc, val_loss = validate(model, val_loader, criterion, device, save_path, class_names, debug, dataset)
         if not debug:
             #wandb.log({"training_accuracy":train_accuracy, "training_loss":train_loss, "validation_acc":val_acc, "validation_loss":val_loss, "epoch":epoch, "learning rate":optimizer.param_groups[-1]['lr']})
             wandb.log({"training_loss":train_loss, "validation_loss":val_loss, "epoch":epoch, "learning rate":optimizer.param_groups[-1]['lr']})
@@ -93,55 +119,86 @@ def train(model, train_loader, val_loader, optimizer, criterion, num_epochs, dev
         else:
             scheduler.step()
 
-        # save best model
+        # save best model. Checkpoint the underlying module: torch.compile wraps the model and would
+        # otherwise save _orig_mod.-prefixed keys that a plain Recon_Transformer/Transformer (infer.py)
+        # can't load, and that differ from what the uncompiled CUDA-graph path saves.
+        saved_model = getattr(model, '_orig_mod', model)
         if val_loss < best_loss:
-            torch.save(model.state_dict(), os.path.join(save_path, 'best_model.pth'))
-        torch.save(model.state_dict(), os.path.join(save_path, 'model.pth'))
+            best_loss = val_loss        # without this every epoch "improved" and best_model.pth was just the latest model
+            torch.save(saved_model.state_dict(), os.path.join(save_path, 'best_model.pth'))
+        torch.save(saved_model.state_dict(), os.path.join(save_path, 'model.pth'))
         
 
-def train_epoch(model, epoch, num_epochs, train_loader, optimizer, criterion, device):
+def train_epoch(model, epoch, num_epochs, train_loader, optimizer, criterion, scaler, amp_dtype, device, dataset, graphed_step=None, train_augment=None):
     model.train()
-    total_correct = 0
-    total_loss = 0
+    # Accumulate metrics in device tensors and only .item() once per epoch. Calling .item() every
+    # step forces a GPU sync that stalls the pipeline.
+    total_correct = torch.zeros((), device=device, dtype=torch.long)
+    total_loss = torch.zeros((), device=device)
+    num_samples = len(train_loader.dataset)
+
+    if device.type == "cuda":
+        train_loader = CUDAPrefetcher(train_loader, device)         # copy next batch on a side stream, overlapped with compute
+
+    if graphed_step == None:
+        model.zero_grad(set_to_none=True)       # drop any grads left over from validation/a previous epoch (the graph replays write into fixed grad tensors, so leave those allocated)
 
     for step, batch in enumerate(tqdm(train_loader)):
         input, target, _ = batch
-        input, target = input.to(device), target.to(device)   
-        output = model(input)                                                 # result is a (num_classes, batch_size) tensor
-        optimizer.zero_grad()
-        loss = criterion(output.squeeze(), target)                                       # take argmax to get the class with the highest "probability"
-        loss.backward()
-        optimizer.step() 
-        #pred = output.squeeze().argmax(dim=1)     # only for classification       
-        total_loss += loss.item()
-        total_correct += (output == target).sum().item()                                  # summing over a list results in a list so need to use .item() to get a number.
-
-    accuracy = total_correct / len(train_loader.dataset)
-    avg_loss = total_loss/ len(train_loader.dataset)
+        input, target = input.to(device, non_blocking=True), target.to(device, non_blocking=True)       # no-op if the prefetcher already moved them
+        if train_augment != None:
+            input = train_augment(input.float().div_(255.0))        # batched GPU augmentation; kornia wants float [0, 1] and the dataset hands over raw uint8 tensors
+        if dataset == "Mirflickr":
+            input, target = normalize_mirflickr(input, target)      # batched min-max rescale on the GPU
+        if graphed_step != None:
+            loss, output = graphed_step(input, target)      # replays the captured forward+loss+backward as one graph launch (zeroing included)
+            optimizer.step()
+        else:
+            # set_to_none frees the grad tensors instead of launching a zeroing kernel per parameter;
+            # backward then writes fresh grads rather than accumulating into zeroed ones
+            optimizer.zero_grad(set_to_none=True)
+            # Run forward + loss under autocast so matmuls/convs hit the tensor cores at reduced precision
+            with torch.autocast(device_type=device.type, dtype=amp_dtype, enabled=(device.type == "cuda")):
+                output = model(input)                                         # result is a (num_classes, batch_size) tensor
+                loss = criterion(output.squeeze(), target)                               # take argmax to get the class with the highest "probability"
+            scaler.scale(loss).backward()       # scaler is a no-op for bf16; scales the loss for fp16
+            scaler.step(optimizer)
+            scaler.update()
+        #pred = output.squeeze().argmax(dim=1)     # only for classification
+        total_loss += loss.detach()
+        total_correct += (output == target).sum()
+
+    accuracy = total_correct.item() / num_samples       # single sync at the end of the epoch
+    avg_loss = total_loss.item() / num_samples
     print(f'Epoch {epoch+1}/{num_epochs}, Loss: {avg_loss}, Accuracy: {accuracy}')
     return accuracy, avg_loss          
 
 
-def validate(model, val_loader, criterion, device, save_path, class_names, debug, load=False):
+def validate(model, val_loader, criterion, device, save_path, class_names, debug, dataset, load=False):
     if load:
         model.load_state_dict(torch.load(save_path))                         # if loading from saved model
     
     model.eval()
     print("Starting validation...")
     with torch.no_grad():
-        total_correct = 0
-        total_loss = 0.0
-        all_targets = [] 
-        all_preds = [] 
+        # accumulate in 0-dim device tensors and sync once after the loop, same as train_epoch;
+        # summing the per-step loss tensors directly kept N small allocations alive and returned a
+        # device tensor that ended up in wandb.log without an .item()
+        total_correct = torch.zeros((), device=device, dtype=torch.long)
+        total_loss = torch.zeros((), device=device)
+        all_targets = []
+        all_preds = []
 
         for step, batch in enumerate(tqdm(val_loader)):
             input, target, _ = batch
-            input, target = input.to(device), target.to(device)
+            input, target = input.to(device, non_blocking=True), target.to(device, non_blocking=True)
+            if dataset == "Mirflickr":
+                input, target = normalize_mirflickr(input, target)
             output = model(input)
             loss = criterion(output.squeeze(), target)                                  # Need to .squeeze() because of headed attention.
             # pred = output.squeeze().argmax(dim=1)
-            total_loss += loss
-            total_correct += (output == target).sum().item()         
+            total_loss += loss.detach()
+            total_correct += (output == target).sum()
 
             # accumulate all targets and preds and then run confusion matrix for classification only
         #     all_targets.extend(pred.cpu().numpy())
@@ -151,8 +208,8 @@ def validate(model, val_loader, criterion, device, save_path, class_names, debug
         #     wandb.log({"conf_mat" : wandb.plot.confusion_matrix(probs=None,                 # Track confusion matrix to see accuracy for each class
         #                     y_true=all_targets, preds=all_preds,
         #                     class_names=class_names)})
-        accuracy = total_correct/len(val_loader.dataset)
-        avg_loss = total_loss/len(val_loader.dataset)
+        accuracy = total_correct.item() / len(val_loader.dataset)       # single sync for the whole validation pass
+        avg_loss = total_loss.item() / len(val_loader.dataset)
         print(f'Validation Loss: {avg_loss}, Validation Accuracy: {accuracy} \n')
         return accuracy, avg_loss
     
@@ -15,6 +15,96 @@ class Rescale(nn.Module):
         return tensor
     
 
+# APEX-style prefetcher. Issues the H2D copy for the next batch on a side CUDA stream so it overlaps
+# with the current step's forward/backward instead of blocking compute on the default stream.
+# Needs pin_memory=True on the wrapped DataLoader for the copies to actually be async.
+class CUDAPrefetcher:
+    def __init__(self, loader, device):
+        self.loader = loader
+        self.device = device
+        self.stream = torch.cuda.Stream()
+
+    def __len__(self):
+        return len(self.loader)        # so tqdm still shows a progress bar
+
+    def __iter__(self):
+        self.iterator = iter(self.loader)
+        self._preload()
+        return self
+
+    def _preload(self):
+        try:
+            self.next_batch = next(self.iterator)
+        except StopIteration:
+            self.next_batch = None
+            return
+        with torch.cuda.stream(self.stream):
+            self.next_batch = tuple(t.to(self.device, non_blocking=True) if torch.is_tensor(t) else t for t in self.next_batch)
+
+    def __next__(self):
+        if self.next_batch is None:
+            raise StopIteration
+        torch.cuda.current_stream().wait_stream(self.stream)            # make sure the side-stream copy finished
+        batch = self.next_batch
+        for t in batch:
+            if torch.is_tensor(t):
+                t.record_stream(torch.cuda.current_stream())            # keep the copy's memory alive until the default stream is done with it
+        self._preload()
+        return batch
+
+
+# Captures one fixed-shape training step (zero grads + forward + loss + backward) as a CUDA graph and
+# replays it as a single launch. At embed_dim=128 every kernel runs for microseconds, so per-kernel
+# launch overhead dominates the step; a graph replay collapses the hundreds of launches into one.
+# Needs fixed batch shapes (drop_last=True on the train loader) and works with bf16 autocast but not
+# the fp16 GradScaler. optimizer.step() is left eager so LR schedulers behave normally.
+class CUDAGraphedStep:
+    def __init__(self, model, criterion, amp_dtype, warmup_iters=3):
+        self.model = model
+        self.criterion = criterion
+        self.amp_dtype = amp_dtype
+        self.warmup_iters = warmup_iters
+        self.graph = None
+
+    def _forward_backward(self):
+        self.model.zero_grad(set_to_none=False)         # grad tensors must stay allocated between replays, so zero in place
+        # cache_enabled=False per the PyTorch CUDA-graphs guidance: autocast's weight-cast cache
+        # must not be baked into (or shared across) the captured graph
+        with torch.autocast(device_type="cuda", dtype=self.amp_dtype, cache_enabled=False):
+            self.static_output = self.model(self.static_input)
+            self.static_loss = self.criterion(self.static_output.squeeze(), self.static_target)
+        self.static_loss.backward()
+
+    def _capture(self, input, target):
+        self.static_input = input.clone()
+        self.static_target = target.clone()
+
+        # warm up on a side stream first so cuBLAS/cuDNN pick their algorithms and grads get allocated
+        stream = torch.cuda.Stream()
+        stream.wait_stream(torch.cuda.current_stream())
+        with torch.cuda.stream(stream):
+            for _ in range(self.warmup_iters):
+                self._forward_backward()
+        torch.cuda.current_stream().wait_stream(stream)
+        torch.cuda.synchronize()
+
+        # thread_local: only CUDA calls from this thread are treated as part of the capture. The
+        # default 'global' mode aborts the capture if any other thread touches CUDA meanwhile - which
+        # the DataLoader's pin-memory thread and the CUDAPrefetcher side stream are doing mid-epoch.
+        self.graph = torch.cuda.CUDAGraph()
+        with torch.cuda.graph(self.graph, capture_error_mode='thread_local'):
+            self._forward_backward()
+
+    # copy the batch into the captured buffers and replay; returns the (static) loss and output tensors
+    def __call__(self, input, target):
+        if self.graph == None:
+            self._capture(input, target)
+        self.static_input.copy_(input)
+        self.static_target.copy_(target)
+        self.graph.replay()
+        return self.static_loss, self.static_output
+
+
 # Same learning rate scheduler as in "Attention is All You Need" paper. Not very good for small datasets
 # Referencing https://github.com/jadore801120/attention-is-all-you-need-pytorch/blob/master/transformer/Optim.py 
 class TransformerScheduler(torch.optim.lr_scheduler.LambdaLR):